@@ -1,68 +1,250 @@
 import os
 import argparse
-import requests
 import json
-import base64
-from kubernetes import client, config
+import binascii
+import fcntl
+import functools
+import hashlib
+import stat
+import tempfile
+import time
+
+# requests, urllib3 and kubernetes are imported where they are used so that
+# argument errors and --help do not pay for loading them.
+
+@functools.lru_cache(maxsize=1)
+def _session():
+    """Returns a shared requests.Session with pooled, retrying connections."""
+    import requests
+    import urllib3
+    from requests.adapters import HTTPAdapter
+
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=8,
+        pool_maxsize=32,
+        # Retrying the registration POST must not register the cluster twice: only
+        # retry failed connects and throttling statuses, never read errors
+        max_retries=urllib3.Retry(
+            total=3,
+            read=0,
+            backoff_factor=0.3,
+            status_forcelist=[429, 503],
+            allowed_methods=urllib3.Retry.DEFAULT_ALLOWED_METHODS | {"POST"},
+            raise_on_status=False  # Return the last response so its status is reported
+        )
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+@functools.lru_cache(maxsize=1)
+def _core_api():
+    """Loads the Kubernetes config once and returns a shared CoreV1Api."""
+    import urllib3
+    from kubernetes import client, config
 
-def get_service_account_token(namespace, service_account_name):
-    """Retrieves the token for a service account."""
     try:
         config.load_incluster_config()
-    except:
+    except config.ConfigException:
         config.load_kube_config()
 
-    api = client.CoreV1Api()
+    configuration = client.Configuration.get_default_copy()
+    configuration.connection_pool_maxsize = 32
+    configuration.retries = urllib3.Retry(
+        total=3,
+        backoff_factor=0.2,
+        status_forcelist=[429, 500, 502, 503, 504],
+        raise_on_status=False  # Hand the last response back so it surfaces as an ApiException
+    )
+    return client.CoreV1Api(client.ApiClient(configuration))
+
+def get_k8s_api_url():
+    """Returns the API server address of the loaded Kubernetes config."""
+    return _core_api().api_client.configuration.host
+
+def _get_secret_token(api, namespace, service_account_name):
+    """Retrieves the (decoded) token from the legacy token secret of a service account."""
+    from kubernetes import client
+
+    sa = api.read_namespaced_service_account(name=service_account_name, namespace=namespace)
+    secrets = sa.secrets
+
+    if secrets:
+        names = [secret.name for secret in secrets]
+
+        try:
+            # One LIST for all token secrets in the namespace instead of a GET per secret
+            token_secrets = api.list_namespaced_secret(
+                namespace=namespace,
+                field_selector="type=kubernetes.io/service-account-token"
+            ).items
+        except client.ApiException as e:
+            if e.status != 403:
+                raise
+            # Roles may only grant `get` (possibly limited by resourceNames), read the secrets by name
+            def read_secrets_by_name():
+                for name in names:
+                    try:
+                        yield api.read_namespaced_secret(name=name, namespace=namespace)
+                    except client.ApiException as e:
+                        # sa.secrets can still reference deleted secrets, skip those
+                        if e.status != 404:
+                            raise
+
+            token_secrets = read_secrets_by_name()
+
+        token = next(
+            (
+                secret.data['token'] for secret in token_secrets
+                if secret.metadata.name in names
+                and secret.type == "kubernetes.io/service-account-token"
+                and secret.data and secret.data.get('token')
+            ),
+            None
+        )
+        if token:
+            return binascii.a2b_base64(token).decode("ascii")  # Secret data is base64, send the raw JWT
+    return None
+
+def get_service_account_token(namespace, service_account_name, expiration_seconds=3600):
+    """Retrieves the (decoded) token for a service account."""
+    from kubernetes import client
+
+    api = _core_api()
 
     try:
-        sa = api.read_namespaced_service_account(name=service_account_name, namespace=namespace)
-        secrets = sa.secrets
-
-        if secrets:
-            for secret in secrets:
-                secret_name = secret.name
-                secret = api.read_namespaced_secret(name=secret_name, namespace=namespace)
-                if secret.type == "kubernetes.io/service-account-token":
-                    token = secret.data.get('token')
-                    if token:
-                        return token  # No need to decode anymore!
-                    else:
-                        print(f"Error: Could not find 'token' in secret '{secret_name}'.")
-
-            print(f"Error: No token secret found for service account '{service_account_name}'.")
-        else:
-            print(f"Error: Service account '{service_account_name}' has no secrets.")
+        # Prefer an existing long-lived token secret so the registered credential does not expire
+        try:
+            token = _get_secret_token(api, namespace, service_account_name)
+            if token:
+                return token
+        except client.ApiException as e:
+            if e.status not in (403, 404):
+                raise
+
+        # No token secret (Kubernetes >= 1.24 no longer creates them): request a bounded token
+        token_request = api.create_namespaced_service_account_token(
+            name=service_account_name,
+            namespace=namespace,
+            body=client.AuthenticationV1TokenRequest(
+                spec=client.V1TokenRequestSpec(audiences=[], expiration_seconds=expiration_seconds)
+            )
+        )
+        return token_request.status.token
 
     except client.ApiException as e:
         print(f"Error retrieving service account token: {e}")
     return None
 
-def make_api_request(api_url, header_name, api_token, payload):
-    """Makes a POST request to the specified API."""
+def _is_private(st):
+    """Returns whether a stat result belongs to the current user and is not accessible by others."""
+    return st.st_uid == os.getuid() and not st.st_mode & 0o077
+
+def token_cache_path(namespace, service_account_name, api_host):
+    """Returns the on-disk cache location for a service account token, or None if it cannot be used."""
+    cache_dir = os.path.join(tempfile.gettempdir(), f"registerk8s-{os.getuid()}")
+    try:
+        try:
+            os.mkdir(cache_dir, 0o700)
+        except FileExistsError:
+            pass
+        st = os.lstat(cache_dir)
+    except OSError as e:
+        print(f"Warning: Not caching service account token, cannot create '{cache_dir}': {e}")
+        return None
+    if not stat.S_ISDIR(st.st_mode) or not _is_private(st):
+        print(f"Warning: Not caching service account token, '{cache_dir}' is not a private directory.")
+        return None
+
+    # Hash the API server, namespace and service account together so tokens of different
+    # clusters/contexts or of names that only differ in where a '-' falls never share a file
+    cache_key = hashlib.sha256(f"{api_host}\0{namespace}\0{service_account_name}".encode("utf-8")).hexdigest()
+    return os.path.join(cache_dir, f"token-{cache_key}")
+
+def read_cached_token(path, ttl):
+    """Returns the cached token at path if it is private and younger than ttl seconds."""
+    try:
+        with open(path, "r", opener=lambda p, flags: os.open(p, flags | os.O_NOFOLLOW)) as f:
+            fcntl.flock(f, fcntl.LOCK_SH)
+            st = os.fstat(f.fileno())
+            if not _is_private(st) or time.time() - st.st_mtime > ttl:
+                return None
+            return f.read() or None
+    except OSError:
+        return None
+
+def write_cached_token(path, token):
+    """Stores the token at path, readable by the current user only."""
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_NOFOLLOW, 0o600)
+        with os.fdopen(fd, "w") as f:
+            if not _is_private(os.fstat(f.fileno())):
+                print(f"Warning: Not caching service account token, '{path}' is not a private file.")
+                return
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.truncate()
+            f.write(token)
+    except OSError as e:
+        print(f"Warning: Could not cache service account token in '{path}': {e}")
+
+def invalidate_cached_token(path):
+    """Removes a cached token, e.g. after the API rejected it."""
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+def build_request_body(payload_str, payload, fields):
+    """Returns the JSON request body: the payload with fields added, as bytes.
+
+    The fields are spliced into the original payload text so it is not
+    re-encoded, which means non-ASCII characters of the payload are sent as
+    raw UTF-8 rather than \\u-escaped. Payloads that already define one of
+    the fields, or that cannot be encoded as UTF-8 (e.g. lone surrogates from
+    undecodable arguments), go through a regular decode/encode instead so the
+    added values still take precedence and the body stays valid.
+    """
+    text = payload_str.strip()
+    if text.endswith("}") and not payload.keys() & fields.keys():
+        encoded_fields = json.dumps(fields, separators=(",", ":"))[1:-1]
+        separator = "," if payload else ""
+        try:
+            return f"{text[:-1].rstrip()}{separator}{encoded_fields}}}".encode("utf-8")
+        except UnicodeEncodeError:
+            pass
+    return json.dumps({**payload, **fields}, separators=(",", ":")).encode("utf-8")
+
+def make_api_request(api_url, header_name, api_token, body):
+    """Makes a POST request with a JSON body to the specified API and returns the response."""
+    import requests
 
     headers = {
         header_name: api_token,
-        "Content-Type": "application/json"
+        "Content-Type": "application/json",
+        "Connection": "keep-alive"
     }
 
     try:
-        response = requests.post(api_url, headers=headers, json=payload)
-        response.raise_for_status()  # Raise an exception for bad status codes
-        print("API request successful:")
-        try:
-            print(json.dumps(response.json(), indent=4)) # Print JSON nicely formatted
-        except json.JSONDecodeError:
-            print(response.text)  # Fallback to printing raw text
-
+        response = _session().post(api_url, headers=headers, data=body, timeout=(3.05, 30))
     except requests.exceptions.RequestException as e:
         print(f"Error making API request: {e}")
-        if response:
-            print(f"Response status code: {response.status_code}")
-            try:
-                print(f"Response content: {response.text}")
-            except:
-                pass
-        raise  # Re-raise the exception after printing info
+        raise
+
+    if response.status_code >= 400:
+        print(f"Error: API request failed with status code {response.status_code}: {response.text}")
+        return response
+
+    print("API request successful:")
+    if response.headers.get("Content-Type", "").startswith("application/json"):
+        try:
+            # Decode the raw bytes, skipping requests' charset detection
+            print(json.dumps(json.loads(response.content), indent=4)) # Print JSON nicely formatted
+            return response
+        except ValueError:
+            pass
+    print(response.text)  # Fallback to printing raw text
+    return response
 
 
 if __name__ == "__main__":
@@ -77,7 +259,9 @@ if __name__ == "__main__":
     # Kubernetes parameters
     parser.add_argument("--namespace", dest="namespace", default=os.environ.get("NAMESPACE", "default"), help="Kubernetes namespace (env: NAMESPACE, default: default)")
     parser.add_argument("--service-account-name", dest="service_account_name", default=os.environ.get("SERVICE_ACCOUNT_NAME", "default"), help="Service account name (env: SERVICE_ACCOUNT_NAME, default: default)")
-    parser.add_argument("--k8s-api-url", dest="k8s_api_url", default=os.environ.get("K8S_API_URL", "https://127.0.0.1"), help="External Kubernetes API address")
+    parser.add_argument("--token-expiration-seconds", dest="token_expiration_seconds", type=int, default=os.environ.get("TOKEN_EXPIRATION_SECONDS", "3600"), help="Lifetime of the token requested through the TokenRequest API when the service account has no token secret; the registered credential expires after it (env: TOKEN_EXPIRATION_SECONDS, default: 3600)")
+    parser.add_argument("--token-cache-ttl", dest="token_cache_ttl", type=int, default=os.environ.get("TOKEN_CACHE_TTL", "3000"), help="Seconds to reuse a token cached on disk, capped below --token-expiration-seconds; 0 disables the cache (env: TOKEN_CACHE_TTL, default: 3000)")
+    parser.add_argument("--k8s-api-url", dest="k8s_api_url", default=os.environ.get("K8S_API_URL"), help="External Kubernetes API address (env: K8S_API_URL, default: API server of the loaded Kubernetes config)")
 
     args = parser.parse_args()
 
@@ -85,32 +269,48 @@ if __name__ == "__main__":
         print("Error: --api-url and --api-token are required (or set API_URL and API_TOKEN env vars).")
         exit(1)
 
-    service_token = get_service_account_token(args.namespace, args.service_account_name)
-    
-    if service_token:
-        try:
-            payload = json.loads(args.payload_str)  
-        except json.JSONDecodeError as e:
-            print(f"Error decoding payload JSON: {e}")
-            exit(1)
+    # Validate the payload before touching the Kubernetes API so bad input fails fast
+    try:
+        payload = json.loads(args.payload_str)
+    except json.JSONDecodeError as e:
+        print(f"Error decoding payload JSON: {e}")
+        exit(1)
+    if not isinstance(payload, dict):
+        print("Error: Payload JSON must be an object.")
+        exit(1)
 
-        b_service_token = base64.b64decode(service_token)
-        s_service_token = b_service_token.decode('utf-8')
-        payload['secret'] = s_service_token
+    # Stop serving a cached token well before a requested token would expire
+    token_cache_ttl = min(args.token_cache_ttl, args.token_expiration_seconds * 5 // 6)
+    token_cache_file = None
+    if token_cache_ttl > 0:
+        token_cache_file = token_cache_path(args.namespace, args.service_account_name, get_k8s_api_url())
+    service_token = read_cached_token(token_cache_file, token_cache_ttl) if token_cache_file else None
 
-    else:
+    if not service_token:
+        service_token = get_service_account_token(args.namespace, args.service_account_name, args.token_expiration_seconds)
+        if service_token and token_cache_file:
+            write_cached_token(token_cache_file, service_token)
+
+    if not service_token:
         print("Failed to retrieve service account token. Exiting.")
         exit(1)
 
-    payload['asset_data'] = dict()
-    payload['asset_data']['api_address'] = args.k8s_api_url
+    body = build_request_body(args.payload_str, payload, {
+        'secret': service_token,
+        'asset_data': {'api_address': args.k8s_api_url or get_k8s_api_url()}
+    })
 
     try:
-        make_api_request(args.api_url, args.header_name, args.api_token, payload)
+        response = make_api_request(args.api_url, args.header_name, args.api_token, body)
     except Exception as e:  # Catch and handle any exceptions during the API request
         print(f"An error occurred during API request: {e}")
         exit(1)
 
+    if response.status_code >= 400:
+        if response.status_code == 401 and token_cache_file:
+            invalidate_cached_token(token_cache_file)
+        exit(2)
+
 
 
 